@@ -1,26 +1,59 @@
+import atexit
 import random
+import runpy
 import string
+import sys
 import os
+import itertools
 import subprocess
-from typing import Union, Optional, Tuple, Any, List
-from shutil import rmtree
-from collections import defaultdict
+import tempfile
+import threading
+from typing import Union, Optional, Tuple, Any, List, Iterator, Dict
+from concurrent.futures import ThreadPoolExecutor, wait
 
 __VERSION__ = '0.1.0'
 __all__ = ['Launcher']
+_MISSING = object()
+_ALPHABET = string.ascii_uppercase + string.digits
+_rng = random.Random()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_rng.seed)  # forked launchers must not share suffixes
+
+_LAUNCH_POOL: Optional[ThreadPoolExecutor] = None
+_RETIRED_POOLS: List[ThreadPoolExecutor] = []  # outgrown pools, possibly still held by other launchers
+_POOL_LOCK = threading.Lock()
+
+
+def _get_pool(max_workers: int) -> ThreadPoolExecutor:
+    global _LAUNCH_POOL
+    with _POOL_LOCK:
+        if _LAUNCH_POOL is None or _LAUNCH_POOL._max_workers < max_workers:
+            if _LAUNCH_POOL is not None:
+                _RETIRED_POOLS.append(_LAUNCH_POOL)  # shut down at exit only
+
+            _LAUNCH_POOL = ThreadPoolExecutor(max_workers=max_workers)
+
+        return _LAUNCH_POOL
+
+
+@atexit.register
+def _shutdown_pool():
+    with _POOL_LOCK:
+        pools = _RETIRED_POOLS + ([_LAUNCH_POOL] if _LAUNCH_POOL is not None else [])
+
+    for pool in pools:
+        pool.shutdown()
 
 
 class Hyperparameter:
+    __slots__ = ('name', 'value', 'tunable')
+
     def __init__(self, name, value, tunable=False):
         self.name = name
         self.value = value
         self.tunable = tunable
 
 
-def _spawn_set():
-    return set()
-
-
 class Launcher:
     """
     Launch a series of experiments against tunable hyperparameters.
@@ -45,8 +78,10 @@ class Launcher:
         The number of GPUs required for the experiment.
         Default: `0`.
      tmp_configs_folder : str
-        The temporary folder to store all the generated config files.
+        The folder in which a temporary directory is created to store
+        all the generated config files during `launch`.
         This folder should be in the local machine.
+        By default, the system temp dir is used.
         Default: `None`.
      experiment_root : str
         The temporary folder to execute the experiment from.
@@ -58,6 +93,17 @@ class Launcher:
         Path to the Python interpreter used for the experiment.
         This Python interpreter should be in the remote machine.
         Default: `None`.
+     max_parallel : int
+        The maximum number of jobs submitted to `ts`/`ms` concurrently.
+        Default: `1`.
+     inprocess : bool
+        Whether to run the script in the current Python process,
+        bypassing `ts`, when there is only one configuration to
+        launch locally without GPUs and extra arguments.
+        `interpreter` is ignored in this case.
+        Modules imported by the script are dropped after the run,
+        but global state such as the gin registry is shared with the launcher.
+        Default: `False`.
 
     """
 
@@ -69,7 +115,9 @@ class Launcher:
                  num_gpus: int = 0,
                  tmp_configs_folder: str = None,
                  experiment_root: str = None,
-                 interpreter: str = None):
+                 interpreter: str = None,
+                 max_parallel: int = 1,
+                 inprocess: bool = False):
         if sync is None:
             sync = []
         else:
@@ -87,32 +135,39 @@ class Launcher:
         self.ignores = list(ignores)
         self.num_gpus = num_gpus
         self.__hyperparameters = {}
-        if tmp_configs_folder is None:
-            tmp_configs_folder = '__tmp__'
-
-        if not os.path.exists(tmp_configs_folder):
-            os.mkdir(tmp_configs_folder)
+        if tmp_configs_folder is not None:
+            os.makedirs(tmp_configs_folder, exist_ok=True)
+            self.ignores.append(tmp_configs_folder)
 
-        self.tmp_folder = tmp_configs_folder
-        self.ignores.append(self.tmp_folder)
+        self.tmp_configs_folder = tmp_configs_folder
+        self.tmp_folder = None  # created in `launch`
         self.server = server
         if experiment_root is None:
             if self.server is None:  # work locally
                 self.tmp_root = '/tmp/launcher-tmp'
-                if not os.path.exists(self.tmp_root):
-                    os.mkdir(self.tmp_root)
+                os.makedirs(self.tmp_root, exist_ok=True)
             else:
                 self.tmp_root = '/tmp/messenger-tmp'
         else:
             self.tmp_root = experiment_root
             if self.server is None:
-                if not os.path.exists(self.tmp_root):
-                    os.mkdir(self.tmp_root)
+                os.makedirs(self.tmp_root, exist_ok=True)
             else:
                 assert os.path.isabs(self.tmp_root), f'Relative experiment root is not allowed. Got {experiment_root}'
 
         self.interpreter = 'python' if interpreter is None else interpreter
-        self._skips = defaultdict(_spawn_set)
+        self._skips: Dict[str, set] = {}
+        self.max_parallel = max_parallel
+        self.inprocess = inprocess
+        self._configs_cache = None  # invalidated whenever the hyperparameters or skips change
+        self._update_excludes()
+
+    def _update_excludes(self) -> None:
+        # exclude patterns in the forms expected by rsync and ms.
+        # `ignores` is public and may change after construction, so this runs again on every launch
+        ignores = list(dict.fromkeys(self.ignores))
+        self._exclude_argv = [f'--exclude={exclude}' for exclude in ignores]
+        self._exclude_joined = ':'.join(ignores)
 
     def set_tunable(self, hyperparameter: str) -> None:
         """
@@ -123,7 +178,10 @@ class Launcher:
         :param hyperparameter:
             name of the hyperparameter
         """
-        self.__hyperparameters[hyperparameter].tunable = True
+        hp = self.__hyperparameters[hyperparameter]
+        hp.value = tuple(hp.value)
+        hp.tunable = True
+        self._configs_cache = None
 
     def add_hyperparameters(self, name: str, value, tunable=False) -> None:
         """
@@ -141,7 +199,9 @@ class Launcher:
         """
         if tunable:
             assert isinstance(value, (list, tuple))
+            value = tuple(value)  # snapshot, so later changes to the list do not go unnoticed by the cache
         self.__hyperparameters[name] = Hyperparameter(name, value, tunable)
+        self._configs_cache = None
 
     def load_config(self, config_file):
         raise NotImplementedError
@@ -149,6 +209,7 @@ class Launcher:
     def save_config(self, config_name, config):
         """
         The config file should be written in the tmp folder.
+        `self.tmp_folder` only exists while `launch` is running and is `None` otherwise.
         For e.g., `config_file = os.path.join(self.tmp_folder, f'{config_name}.txt')`
         The function should return config_file.
 
@@ -170,64 +231,86 @@ class Launcher:
             self.add_hyperparameters(k, v)
 
     def skip_for(self, name: str, value: Union[Tuple[Any, ...], Any]) -> None:
-        if not isinstance(value, (list, tuple)):
-            value = [value]
-        for v in value:
-            self._skips[name].add(v)
+        self._skips.setdefault(name, set()).update(value if isinstance(value, (list, tuple)) else [value])
+        self._configs_cache = None
 
     def _skip_this(self, config):
-        for k, v in config.items():
-            if k in self._skips:
-                if v in self._skips[k]:
-                    return True
+        for k, banned in self._skips.items():
+            if config.get(k, _MISSING) in banned:
+                return True
         return False
 
-    def generate_configs(self) -> dict:
+    def generate_configs(self) -> Iterator[Tuple[str, dict]]:
         """
         Generates a matrix of configurations.
-        """
-        hyperparameters = list(self.__hyperparameters.values())
+        Values marked by :meth:`skip_for` are pruned from tunable hyperparameters.
+        The matrix is computed once and reused until the hyperparameters
+        or skips are modified.
 
-        def _generate(i, name):
-            if i == len(hyperparameters):
-                return {name: {}}
-
-            configs = {}
-            hp = hyperparameters[i]
-            values = hp.value if hp.tunable else [hp.value]
-            for value in values:
-                if hp.tunable:
-                    if name:
-                        tmp_name = f'{name}-{hp.name}-{value}'
-                    else:
-                        tmp_name = f'{hp.name}-{value}'
-                else:
-                    tmp_name = name
+        :return:
+            an iterator of `(config_name, config)` pairs.
+            Each config is a fresh copy and can be modified freely.
+            Wrap with `dict(...)` to materialize all configurations.
+        """
+        if self._configs_cache is None:
+            self._configs_cache = list(self._generate_configs())
 
-                for key, conf in _generate(i + 1, tmp_name).items():
-                    conf[hp.name] = value
-                    configs[key] = conf
+        return ((config_name, dict(config)) for config_name, config in self._configs_cache)
 
-            return configs
+    def _generate_configs(self) -> Iterator[Tuple[str, dict]]:
+        hyperparameters = list(self.__hyperparameters.values())
+        skips = self._skips
+        tunable_hps = [(hp.name, [v for v in hp.value if v not in skips.get(hp.name, ())])
+                       for hp in hyperparameters if hp.tunable]
+        fixed = {hp.name: hp.value for hp in hyperparameters if not hp.tunable}
+        tunable_names = [name for name, _ in tunable_hps]
 
-        return _generate(0, '')
+        for combo in itertools.product(*[values for _, values in tunable_hps]):
+            config_name = '-'.join(f'{name}-{value}' for name, value in zip(tunable_names, combo))
+            yield config_name, {**fixed, **dict(zip(tunable_names, combo))}
 
     def _sync(self, files_and_folders: List[str], target: str):
         if target is None:
             tmpdir = os.path.join(self.tmp_root, 'tmp-')
-            tmpdir += ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
+            tmpdir += ''.join(_rng.choices(_ALPHABET, k=5))
         else:
             tmpdir = target
 
-        exclude = [f'--exclude={exclude}' for exclude in self.ignores] if self.ignores else []
-        for to_sync in files_and_folders:
-            cmd = ['rsync', '-uar', to_sync]
-            cmd += exclude
-            cmd += [f'{tmpdir}/']
-            subprocess.call(cmd)  # sync using rsync
+        if files_and_folders:
+            cmd = ['rsync', '-uar', *files_and_folders, *self._exclude_argv, f'{tmpdir}/']
+            # sync everything in a single rsync call, raise rather than queue a job in an incomplete directory
+            subprocess.run(cmd, check=True, close_fds=False, stdin=subprocess.DEVNULL)
 
         return tmpdir
 
+    @staticmethod
+    def _submit(job: Tuple[List[str], Optional[str]]) -> int:
+        cmd, working_dir = job
+        # launch ts inside the working dir, raise if the job cannot be queued
+        return subprocess.run(cmd, cwd=working_dir, check=True, close_fds=False,
+                              stdin=subprocess.DEVNULL).returncode
+
+    @staticmethod
+    def _run_inprocess(working_dir: str, script: str, *args: str) -> None:
+        argv, path, current_dir = sys.argv, list(sys.path), os.getcwd()
+        modules = set(sys.modules)
+        sys.argv = [script, *args]
+        sys.path.insert(0, working_dir)
+        os.chdir(working_dir)
+        try:
+            runpy.run_path(script, run_name='__main__')
+        except SystemExit as e:
+            # mirror `check=True` in `_submit`: a clean exit is a success
+            if e.code not in (None, 0):
+                returncode = e.code if isinstance(e.code, int) else 1
+                raise subprocess.CalledProcessError(returncode, sys.argv) from None
+        finally:
+            os.chdir(current_dir)
+            sys.argv = argv
+            sys.path[:] = path
+            for module in set(sys.modules) - modules:  # re-import from the next synced snapshot
+                del sys.modules[module]
+
     @staticmethod
     def _standardize_folder_name(name: str):
         for char in '/> |:&':
@@ -244,22 +327,20 @@ class Launcher:
             extra arguments to be passed to script.
         :return:
         """
+        self._update_excludes()
         to_sync = list(self.sync)
-        config_name = ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
+        config_name = ''.join(_rng.choices(_ALPHABET, k=5))
         tmpdir = os.path.join(self.tmp_root, config_name)
         print(f'Launching from {tmpdir}...')
         if self.server is None:  # work locally
             working_dir = self._sync(to_sync, tmpdir)
             cmd = ['ts']
-            current_dir = os.getcwd()
-            os.chdir(working_dir)  # cd here to launch ts inside
         else:
+            working_dir = None
             to_sync = ':'.join(to_sync)
             cmd = ['ms', '-H', str(self.server), '--sync', to_sync]
-            if self.ignores:
-                exclude = ':'.join(self.ignores)
-                exclude = ['--exclude', f'{exclude}']
-                cmd.extend(exclude)
+            if self._exclude_joined:
+                cmd.extend(['--exclude', self._exclude_joined])
             cmd += ['--sync_dest', tmpdir]
 
         if self.num_gpus:
@@ -276,7 +357,7 @@ class Launcher:
         else:
             raise ValueError  # should never end up here
 
-        subprocess.call(cmd)
+        self._submit((cmd, working_dir))
 
     def launch(self, script: str, extra_args: List[str] = None) -> None:
         """
@@ -287,55 +368,86 @@ class Launcher:
         :param extra_args:
             extra arguments to be passed to script.
         """
-        all_configs = self.generate_configs()
-        for config_name, config in all_configs.items():
-            if self._skip_this(config):
-                continue
-
-            if not config_name:
-                config_name = 'default'
-
-            config_name = self._standardize_folder_name(config_name)
-            config_file = self.save_config(config_name, config)
-            config_filename = os.path.basename(config_file)
-
-            to_sync = list(self.sync)
-            to_sync.append(config_file)
-            tmpdir = os.path.join(self.tmp_root, config_name)
-            tmpdir += '-'
-            tmpdir += ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
-            if self.server is None:  # work locally
-                working_dir = self._sync(to_sync, tmpdir)
-                cmd = ['ts']
-                current_dir = os.getcwd()
-                os.chdir(working_dir)  # cd here to launch ts inside
-            else:
-                to_sync = ':'.join(to_sync)
-                cmd = ['ms', '-H', str(self.server), '--sync', to_sync]
-                if self.ignores:
-                    exclude = ':'.join(self.ignores)
-                    exclude = ['--exclude', f'{exclude}']
-                    cmd.extend(exclude)
-                cmd += ['--sync_dest', tmpdir]
-
-            if self.num_gpus:
-                cmd += ['-G', f'{self.num_gpus}']
-
-            cmd += ['-L', f'{self.name}-{config_name}']
-            script_cmd = [self.interpreter, script, config_filename]
-            if extra_args is not None:
-                script_cmd += list(extra_args)
-            if cmd[0] == 'ms':
-                cmd.append(' '.join(script_cmd))
-            elif cmd[0] == 'ts':
-                cmd += script_cmd
-            else:
-                raise ValueError  # should never end up here
+        self._update_excludes()
+        tmp_root = self.tmp_root
+        name = self.name
+        interpreter = self.interpreter
+        server = self.server
+        sync = self.sync
+        num_gpus = self.num_gpus
+        exclude_joined = self._exclude_joined
+        extra_args = list(extra_args) if extra_args is not None else []
+
+        with tempfile.TemporaryDirectory(prefix='launcher-', dir=self.tmp_configs_folder) as tmp_folder:
+            self.tmp_folder = tmp_folder
+            try:
+                configs = filter(lambda nc: not self._skip_this(nc[1]), self.generate_configs())
+                head = list(itertools.islice(configs, 2))  # enough to tell whether there is a single config
+                inprocess = self.inprocess and len(head) == 1 and server is None and not num_gpus \
+                    and not extra_args
+
+                jobs = []
+                for config_name, config in itertools.chain(head, configs):
+                    if not config_name:
+                        config_name = 'default'
+
+                    config_name = self._standardize_folder_name(config_name)
+                    config_file = self.save_config(config_name, config)
+                    config_filename = os.path.basename(config_file)
+
+                    to_sync = list(sync)
+                    to_sync.append(config_file)
+                    tmpdir = os.path.join(tmp_root, config_name)
+                    tmpdir += '-'
+                    tmpdir += ''.join(_rng.choices(_ALPHABET, k=5))
+                    if server is None:  # work locally
+                        working_dir = self._sync(to_sync, tmpdir)
+                        if inprocess:
+                            self._run_inprocess(working_dir, script, config_filename)
+                            continue
+
+                        cmd = ['ts']
+                    else:
+                        working_dir = None
+                        to_sync = ':'.join(to_sync)
+                        cmd = ['ms', '-H', str(server), '--sync', to_sync]
+                        if exclude_joined:
+                            cmd.extend(['--exclude', exclude_joined])
+                        cmd += ['--sync_dest', tmpdir]
+
+                    if num_gpus:
+                        cmd += ['-G', f'{num_gpus}']
+
+                    cmd += ['-L', f'{name}-{config_name}']
+                    script_cmd = [interpreter, script, config_filename, *extra_args]
+                    if cmd[0] == 'ms':
+                        cmd.append(' '.join(script_cmd))
+                    elif cmd[0] == 'ts':
+                        cmd += script_cmd
+                    else:
+                        raise ValueError  # should never end up here
 
-            subprocess.call(cmd)
-            if self.server is None:
-                os.chdir(current_dir)  # cd back
-        rmtree(self.tmp_folder)
+                    jobs.append((cmd, working_dir))
+
+                # all syncing and config writing is done above,
+                # so the submissions are independent of each other
+                if self.max_parallel > 1:
+                    limit = threading.BoundedSemaphore(self.max_parallel)  # the shared pool may be larger
+
+                    def _submit_limited(job):
+                        with limit:
+                            return self._submit(job)
+
+                    pool = _get_pool(self.max_parallel)
+                    futures = [pool.submit(_submit_limited, job) for job in jobs]
+                    wait(futures)  # the config folder must outlive every submission
+                    for future in futures:
+                        future.result()  # re-raise the first error, if any
+                else:
+                    for job in jobs:  # keep the queueing order
+                        self._submit(job)
+            finally:
+                self.tmp_folder = None  # the folder is removed on exit
 
 
 class GinLauncher(Launcher):
@@ -348,27 +460,21 @@ class GinLauncher(Launcher):
                  num_gpus: int = 0,
                  tmp_configs_folder: str = None,
                  experiment_root: str = None,
-                 interpreter: str = None):
-        super().__init__(name, sync, ignores, server, num_gpus, tmp_configs_folder, experiment_root, interpreter)
+                 interpreter: str = None,
+                 max_parallel: int = 1,
+                 inprocess: bool = False):
+        super().__init__(name, sync, ignores, server, num_gpus, tmp_configs_folder, experiment_root, interpreter,
+                         max_parallel, inprocess)
         self.configurable = configurable
 
     def save_config(self, config_name, config):
         config_filename = f'{self.name}-{config_name}.gin'
         config_file = os.path.join(self.tmp_folder, config_filename)
-        headers = [
-            f'{self.configurable}.name = "{self.name}" \n',
-            f'{self.configurable}.experiment = "{config_name}" \n'
-        ]
-        contents = []
-        for k, v in config.items():
-            if isinstance(v, str):
-                contents.append(f'{self.configurable}.{k} = "{v}" \n')
-            else:
-                contents.append(f'{self.configurable}.{k} = {v} \n')
-
-        with open(config_file, 'w') as f:
-            f.writelines(headers)
-            f.writelines(contents)
-            f.close()
+        prefix = f'{self.configurable}.'
+        lines = [f'{prefix}name = "{self.name}" \n', f'{prefix}experiment = "{config_name}" \n']
+        lines.extend(f'{prefix}{k} = "{v}" \n' if isinstance(v, str) else f'{prefix}{k} = {v} \n'
+                     for k, v in config.items())
+        with open(config_file, 'wb') as f:
+            f.write(''.join(lines).encode('utf-8'))
 
         return config_file